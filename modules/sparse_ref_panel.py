@@ -10,6 +10,7 @@ The reference panel is stored in a zstd-compressed zip archive:
     variants - binary array of variants in panel
     chunks - binary array of chunks with start and stop positions
     haplotypes/* - chunks stored as boolean sparse npz files
+    zstd_dict - optional zstd dictionary used to compress the haplotype chunks
 
 Chunks are cached when they are read into memory. While a few seconds
 processing time is required to load each chunk, consecutive reads are very fast.
@@ -25,6 +26,11 @@ ref_panel = SparseReferencePanel("/data/30x/chr20.srp").from_bcf("/data/30x/chr2
 To open existing sparse reference file:
 ref_panel = SparseReferencePanel("/data/30x/chr20.srp")
 
+The archive stays open while the panel is in use. To release it, call close
+or open the panel as a context manager:
+with SparseReferencePanel("/data/30x/chr20.srp") as ref_panel:
+    ...
+
 To get haplotype calls, the class acts like a sparse matrix:
 sparse_matrix = ref_panel[variants, haplotypes]
 
@@ -33,24 +39,56 @@ sparse_matrix = ref_panel.all
 
 To select a part of the chromosome by position, use range:
 sparse_matrix = ref_panel.range(start_pos, end_pos)
+
+To share loaded chunks between processes on the same host, use shared_cache:
+ref_panel = SparseReferencePanel("/data/30x/chr20.srp", shared_cache=True)
+Each chunk is then decompressed once into shared memory, and other processes
+opening the same file reuse it. A chunk stays in shared memory while it is in the
+cache of the process that loaded it, and each process maps at most cache_size
+chunks, so memory use is bounded by cache_size. If shared memory is full,
+chunks are loaded per process.
 """
 
 import os
+import weakref
+import mmap
 import subprocess
-from io import BytesIO
+from io import BufferedReader, BytesIO
 from pathlib import Path
 from hashlib import blake2b
-from typing import List, Tuple, Union
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 import json
 from datetime import datetime
 from zipfile import ZipFile, BadZipFile
-from tempfile import TemporaryDirectory
+from tempfile import TemporaryDirectory, TemporaryFile
 import concurrent.futures
-
-from zstd import compress, uncompress
+from collections import OrderedDict
+import threading
+from functools import cached_property
+from itertools import repeat
+from multiprocessing import resource_tracker
+
+from zstandard import (
+    ZstdCompressionDict,
+    ZstdCompressor,
+    ZstdDecompressor,
+    ZstdError,
+    train_dictionary,
+)
 import numpy as np
 from scipy import sparse
-from cachetools import LRUCache, cachedmethod
+from numba import njit
+from xxhash import xxh64_hexdigest
 
 from tqdm import tqdm
 from joblib import Parallel, delayed
@@ -59,14 +97,256 @@ import cyvcf2
 
 from .utils import add_suffix, tqdm_joblib
 
+STREAM_BLOCK_SIZE = 1 << 20
+MAX_LOAD_THREADS = 8
+SHARED_MEMORY_DIR = "/dev/shm"
+# ready flag, n_rows, n_cols, nnz and index itemsize of a shared chunk
+SHARED_HEADER_SIZE = 5
+ZSTD_BUFFER_SIZE = 32 * 1024
+ZSTD_DICT_SIZE = 100_000
+ZSTD_DICT_SAMPLES = 100
+_compressor = ZstdCompressor()
+_decompressor = ZstdDecompressor()
+
+
+ALLELE_HASH = "xxh64"
+# archives without an allele_hash in the metadata were hashed with blake2b
+ALLELE_HASHES: Dict[str, Callable[[bytes], str]] = {
+    "blake2b": lambda allele: blake2b(allele, digest_size=8).hexdigest(),
+    "xxh64": xxh64_hexdigest,
+}
+
+
+def compress(data: bytes) -> bytes:
+    """Compress bytes for storage in the archive"""
+    return _compressor.compress(data)
+
+
+def _stream_reader(
+    obj, decompressor: ZstdDecompressor = _decompressor
+) -> BufferedReader:
+    """Decompress an archive member while it is being read"""
+    return BufferedReader(decompressor.stream_reader(obj), buffer_size=ZSTD_BUFFER_SIZE)
+
+
+def _train_zstd_dict(samples: List[bytes]) -> Optional[ZstdCompressionDict]:
+    """Train a zstd dictionary, or return None if there is too little data"""
+    try:
+        return train_dictionary(ZSTD_DICT_SIZE, samples)
+    except ZstdError:
+        return None
+
+
+class _SharedBlock:
+    """
+    Memory mapped file in /dev/shm holding a chunk shared between processes.
+    Only the process that creates a block registers it with the resource tracker,
+    which unlinks it if that process dies before unlinking it itself.
+    """
+
+    def __init__(self, name: str, buf: mmap.mmap) -> None:
+        self.name = name
+        self.buf = buf
+
+    @property
+    def path(self) -> str:
+        return os.path.join(SHARED_MEMORY_DIR, self.name)
+
+    def close(self):
+        self.buf.close()
+
+    def unlink(self):
+        """Remove the block, processes that mapped it keep their mapping"""
+        # unregister first, so a process creating the block again registers after
+        resource_tracker.unregister(f"/{self.name}", "shared_memory")
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def _attach_shared_memory(name: str) -> Optional[_SharedBlock]:
+    """Attach to a shared memory block, without unlinking it when this process exits"""
+    try:
+        fd = os.open(os.path.join(SHARED_MEMORY_DIR, name), os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        size = os.fstat(fd).st_size
+        # the creating process may not have allocated the block yet
+        if size < SHARED_HEADER_SIZE * np.dtype(np.int64).itemsize:
+            return None
+        return _SharedBlock(name, mmap.mmap(fd, size, access=mmap.ACCESS_READ))
+    finally:
+        os.close(fd)
+
+
+def _share_matrix(name: str, matrix: sparse.csc_matrix) -> Optional[_SharedBlock]:
+    """
+    Copy a boolean csc matrix into a new shared memory block.
+    Returns None if the block already exists or there is not enough shared memory.
+    """
+    if matrix.dtype != np.bool_ or not os.path.isdir(SHARED_MEMORY_DIR):
+        return None
+    indptr = matrix.indptr.astype(matrix.indices.dtype, copy=False)
+    indices = matrix.indices[: matrix.nnz]
+    header_bytes = SHARED_HEADER_SIZE * np.dtype(np.int64).itemsize
+    nbytes = header_bytes + indptr.nbytes + indices.nbytes + matrix.nnz
+    path = os.path.join(SHARED_MEMORY_DIR, name)
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError:
+        return None
+    try:
+        # fails when shared memory is full, instead of a SIGBUS when writing to it
+        os.posix_fallocate(fd, 0, nbytes)
+        block = _SharedBlock(name, mmap.mmap(fd, nbytes))
+    except OSError:
+        os.unlink(path)
+        return None
+    finally:
+        os.close(fd)
+    resource_tracker.register(f"/{name}", "shared_memory")
+
+    offset = header_bytes
+    for array in (indptr, indices, matrix.data[: matrix.nnz]):
+        dest = np.ndarray(array.shape, array.dtype, buffer=block.buf, offset=offset)
+        dest[:] = array
+        offset += array.nbytes
+    header = np.ndarray(SHARED_HEADER_SIZE, dtype=np.int64, buffer=block.buf)
+    header[1:] = (*matrix.shape, matrix.nnz, indices.itemsize)
+    # mark as ready last, so other processes never read a partial matrix
+    header[0] = 1
+    return block
+
+
+def _matrix_from_shared_memory(block: _SharedBlock) -> Optional[sparse.csc_matrix]:
+    """Get csc matrix backed by a shared memory block, or None if it is not ready"""
+    header = np.ndarray(SHARED_HEADER_SIZE, dtype=np.int64, buffer=block.buf)
+    ready, n_rows, n_cols, nnz, index_size = header
+    if not ready:
+        return None
+    index_dtype = np.dtype(f"i{index_size}")
+    offset = header.nbytes
+    indptr = np.ndarray(n_cols + 1, dtype=index_dtype, buffer=block.buf, offset=offset)
+    offset += indptr.nbytes
+    indices = np.ndarray(nnz, dtype=index_dtype, buffer=block.buf, offset=offset)
+    offset += indices.nbytes
+    data = np.ndarray(nnz, dtype=np.bool_, buffer=block.buf, offset=offset)
+    return sparse.csc_matrix(
+        (data, indices, indptr), shape=(n_rows, n_cols), copy=False
+    )
+
+
+class StringArray:
+    """
+    Read-only sequence of strings kept in a single newline delimited buffer.
+    Strings are only decoded when they are accessed.
+    """
+
+    def __init__(self, buffer: bytes, offsets: Optional[np.ndarray] = None) -> None:
+        self._buffer = buffer
+        if offsets is None:
+            # start of each string, plus one past the end of the buffer
+            offsets = np.concatenate(
+                (
+                    [0],
+                    np.flatnonzero(np.frombuffer(buffer, dtype=np.uint8) == 10) + 1,
+                    [len(buffer) + 1],
+                )
+            )
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return self._offsets.size - 1
+
+    def __getitem__(self, key: Union[int, slice]) -> Union[str, "StringArray"]:
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                strings = [self[idx] for idx in range(start, stop, step)]
+                if not strings:
+                    # an empty buffer alone would hold one empty string
+                    return StringArray(b"", np.zeros(1, dtype=int))
+                return StringArray("\n".join(strings).encode())
+            return StringArray(
+                self._buffer, self._offsets[start : max(start, stop) + 1]
+            )
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError(f"Index {key} out of range for {len(self)} strings")
+        return self._buffer[self._offsets[key] : self._offsets[key + 1] - 1].decode()
+
+    def __iter__(self) -> Iterator[str]:
+        return (self[idx] for idx in range(len(self)))
+
+
+def _grow_array(array: np.ndarray, n_used: int, size: int) -> np.ndarray:
+    """Copy the used start of an array into a new, larger array"""
+    grown = np.empty(size, dtype=array.dtype)
+    grown[:n_used] = array[:n_used]
+    return grown
+
+
+@njit(cache=True)
+def parse_gt_stream(
+    buf: np.ndarray, state: np.ndarray, rows: np.ndarray, cols: np.ndarray, n_alts: int
+) -> int:
+    """
+    Scan a block of bytes of '|' delimited genotypes with one variant per line,
+    as output by bcftools query -f '[|%GT]\n', appending row and column indices
+    of alt alleles to rows and cols. A leading '|' on each line is skipped.
+    state holds (row, col, n_cols, is_alt, line_start) and is updated in place,
+    so a line may continue into the next block.
+    rows and cols must have room for n_alts + buf.size // 2 + 1 alleles.
+    Returns the number of alt alleles
+    """
+    row, col, n_cols, is_alt, line_start = state
+    for byte in buf:
+        if line_start:
+            line_start = 0
+            if byte == 124:  # "|"
+                continue
+        if byte == 124 or byte == 10:  # "|" or "\n"
+            if is_alt:
+                rows[n_alts] = row
+                cols[n_alts] = col
+                n_alts += 1
+                is_alt = 0
+            if byte == 124:
+                col += 1
+            else:
+                if n_cols == -1:
+                    n_cols = col + 1
+                elif col + 1 != n_cols:
+                    raise ValueError("Variants have different numbers of genotypes")
+                row += 1
+                col = 0
+                line_start = 1
+        elif 49 <= byte <= 57:  # "1" to "9"
+            is_alt = 1
+        elif byte != 48:  # "0"
+            raise ValueError("Genotypes must be phased and non-missing")
+    state[0] = row
+    state[1] = col
+    state[2] = n_cols
+    state[3] = is_alt
+    state[4] = line_start
+    return n_alts
+
 
 class SparseReferencePanel:
     """Class for working with ref panels stored as sparse matrix"""
 
-    def __init__(self, filepath: str, cache_size: int = 2) -> None:
+    def __init__(
+        self, filepath: str, cache_size: int = 2, shared_cache: bool = False
+    ) -> None:
         self.filepath = filepath
         if not os.path.exists(self.filepath):
             self._create()
+        # kept open for the lifetime of the panel, see close
+        self._archive = ZipFile(self.filepath, mode="r")
         self.metadata = self._load_metadata()
         self.variant_dtypes = np.dtype(
             [
@@ -78,11 +358,64 @@ class SparseReferencePanel:
             ]
         )
         self.variants: np.ndarray = self._load_variants()
+        self._positions = np.ascontiguousarray(self.variants["pos"])
         self.chunks: np.ndarray = self._load_chunks()
-        self.ids: List[str] = self._load_ids()
-        self.original_ids: List[str] = self._load_original_ids()
+        self._chunk_ids = self._get_chunk_ids()
         self.sample_ids: List[str] = self._load_sample_ids()
-        self._cache = LRUCache(maxsize=cache_size)
+        self._zstd_dict: Optional[ZstdCompressionDict] = self._load_zstd_dict()
+        # least recently used chunks are at the start of the caches
+        self._cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._csr_cache: OrderedDict = OrderedDict()
+        self.shared_cache = shared_cache
+        self._shared_key = self._get_shared_key()
+        # blocks created by this panel for chunks in its cache
+        self._shared_blocks: Dict[int, weakref.finalize] = {}
+        self._init_threads()
+
+    def _init_threads(self):
+        """Create thread pool for loading chunks and lock for the caches"""
+        # guards the caches, which are shared by the loading threads
+        self._lock = threading.Lock()
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(os.cpu_count() or 1, MAX_LOAD_THREADS)
+        )
+
+    def __getstate__(self):
+        # open files, zstd dictionaries, locks and thread pools cannot be pickled
+        # when sending tasks to joblib workers
+        state = self.__dict__.copy()
+        for attr in ("_archive", "_zstd_dict", "_lock", "_pool", "_shared_blocks"):
+            del state[attr]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._shared_blocks = {}
+        self._archive = ZipFile(self.filepath, mode="r")
+        self._zstd_dict = self._load_zstd_dict()
+        self._init_threads()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, "_archive"):
+            self.close()
+
+    def close(self):
+        """Close the archive and stop the threads used for loading chunks"""
+        self._archive.close()
+        if hasattr(self, "_pool"):
+            self._pool.shutdown(wait=False)
+        if hasattr(self, "_shared_blocks"):
+            self._cache.clear()
+            self._csr_cache.clear()
+            for chunk in list(self._shared_blocks):
+                self._unshare_chunk(chunk)
 
     def __len__(self):
         return self.n_variants
@@ -111,10 +444,13 @@ class SparseReferencePanel:
             chunk_step = -1 if key[0].step and key[0].step < 0 else 1
             if not key[0].start and key[0].stop is None:
                 return sparse.vstack(
-                    [
-                        self._load_haplotypes(chunk)[:: key[0].step, key[1]]
-                        for chunk in self.chunks[:, 0]
-                    ]
+                    self._map_chunks(
+                        self._slice_chunk,
+                        self._chunk_ids,
+                        repeat(slice(None, None, key[0].step)),
+                        repeat(key[1]),
+                    ),
+                    format="csc",
                 )
             row_stop = (
                 min(key[0].stop, self.n_variants)
@@ -147,10 +483,8 @@ class SparseReferencePanel:
                 + [slice(None, chunk_row_stop, key[0].step)]
             )
             return sparse.vstack(
-                [
-                    self._load_haplotypes(chunk)[slice_, key[1]]
-                    for chunk, slice_ in zip(chunks, slices)
-                ]
+                self._map_chunks(self._slice_chunk, chunks, slices, repeat(key[1])),
+                format="csc",
             )
 
         # handle list of indexes
@@ -162,7 +496,8 @@ class SparseReferencePanel:
             raise TypeError("Variant selection must be int, List[int], or slice")
 
         chunks, splits = np.unique(rows // self.chunk_size, return_index=True)
-        if any(chunk not in self.chunks[:, 0] for chunk in chunks):
+        # chunks are sorted and numbered 0 to n_chunks - 1
+        if chunks[0] < 0 or chunks[-1] >= self.n_chunks:
             raise IndexError(
                 f"Index {key[0]} out of range for {self.n_variants} variants"
             )
@@ -170,11 +505,21 @@ class SparseReferencePanel:
         chunk_idx = np.split(rows % self.chunk_size, splits[1:])
 
         return sparse.vstack(
-            [
-                self._load_haplotypes(chunk).tocsr()[idx, :]
-                for chunk, idx in zip(chunks, chunk_idx)
-            ]
-        ).tocsc()[:, key[1]]
+            self._map_chunks(self._index_chunk, chunks, chunk_idx, repeat(key[1])),
+            format="csc",
+        )
+
+    def _map_chunks(self, func: Callable, chunks: Iterable[int], *args) -> list:
+        """Apply func to chunks in parallel threads, keeping chunk order"""
+        return list(self._pool.map(func, chunks, *args))
+
+    def _slice_chunk(self, chunk: int, rows: slice, cols) -> sparse.spmatrix:
+        """Slice variants and haplotypes of a chunk"""
+        return self._load_haplotypes(chunk)[rows, cols]
+
+    def _index_chunk(self, chunk: int, rows: np.ndarray, cols) -> sparse.csc_matrix:
+        """Select variants by index and then haplotypes of a chunk"""
+        return self._load_haplotypes_csr(chunk)[rows, :].tocsc()[:, cols]
 
     def _create(self):
         """Create an empty file"""
@@ -196,6 +541,17 @@ class SparseReferencePanel:
     def _save(self, hap_dir: str):
         """Update archive"""
         self.metadata["updated_at"] = str(datetime.now())
+        hap_files = sorted(Path(hap_dir).iterdir(), key=lambda file: int(file.stem))
+        zstd_dict = _train_zstd_dict(
+            [file.read_bytes() for file in hap_files[:ZSTD_DICT_SAMPLES]]
+        )
+        hap_compressor = (
+            _compressor
+            if zstd_dict is None
+            else ZstdCompressor(dict_data=zstd_dict, level=3)
+        )
+        self._zstd_dict = zstd_dict
+        self._archive.close()
         with ZipFile(self.filepath, mode="w") as archive:
             with archive.open("metadata", "w") as metadata:
                 metadata.write(compress(json.dumps(self.metadata).encode()))
@@ -209,51 +565,62 @@ class SparseReferencePanel:
                 chunks.write(compress(self.chunks.tobytes()))
             with archive.open("sample_ids", "w") as sample_ids_file:
                 sample_ids_file.write(compress("\n".join(self.sample_ids).encode()))
-            for file in Path(hap_dir).iterdir():
-                archive.write(file, arcname=os.path.join("haplotypes", file.name))
+            if zstd_dict is not None:
+                with archive.open("zstd_dict", "w") as zstd_dict_file:
+                    zstd_dict_file.write(zstd_dict.as_bytes())
+            for file in hap_files:
+                with archive.open(os.path.join("haplotypes", file.name), "w") as hap:
+                    hap.write(hap_compressor.compress(file.read_bytes()))
+        self._archive = ZipFile(self.filepath, mode="r")
+        self._shared_key = self._get_shared_key()
+
+    def _load_zstd_dict(self) -> Optional[ZstdCompressionDict]:
+        """Load zstd dictionary used for haplotypes from archive, if present"""
+        if "zstd_dict" not in self._archive.namelist():
+            return None
+        with self._archive.open("zstd_dict") as obj:
+            return ZstdCompressionDict(obj.read())
 
     def _load_metadata(self) -> dict:
         """Load metadata from archive"""
-        with ZipFile(self.filepath, mode="r") as archive:
-            with archive.open("metadata") as obj:
-                return json.loads(uncompress(obj.read()))
+        with _stream_reader(self._archive.open("metadata")) as obj:
+            return json.load(obj)
 
     def _load_variants(self) -> np.ndarray:
         """Load variants from archive"""
-        with ZipFile(self.filepath, mode="r") as archive:
-            with archive.open("variants") as obj:
-                return np.frombuffer(uncompress(obj.read()), dtype=self.variant_dtypes)
+        with _stream_reader(self._archive.open("variants")) as obj:
+            return np.frombuffer(obj.read(), dtype=self.variant_dtypes)
 
-    def _load_ids(self) -> List[str]:
+    def _load_ids(self) -> Sequence[str]:
         """Load string formatted variant IDs from archive"""
         try:
-            with ZipFile(self.filepath, mode="r") as archive:
-                with archive.open("IDs") as obj:
-                    return uncompress(obj.read()).decode().split("\n")
+            with _stream_reader(self._archive.open("IDs")) as obj:
+                return StringArray(obj.read())
         except KeyError:
-            return [
-                "-".join([str(col) for col in variant]) for variant in self.variants
-            ]
+            ids = self.variants["chr"].astype(str)
+            for field in ("pos", "ref", "alt"):
+                ids = np.char.add(
+                    np.char.add(ids, "-"), self.variants[field].astype(str)
+                )
+            return ids
 
-    def _load_original_ids(self) -> List[str]:
+    def _load_original_ids(self) -> Sequence[str]:
         """Load original vcf/bcf ID field from archive"""
         try:
-            with ZipFile(self.filepath, mode="r") as archive:
-                with archive.open("original_IDs") as obj:
-                    return uncompress(obj.read()).decode().split("\n")
+            with _stream_reader(self._archive.open("original_IDs")) as obj:
+                return StringArray(obj.read())
         except KeyError:
-            return self._load_ids()
+            return self.ids
 
     def _load_sample_ids(self) -> List[str]:
         """Load sample IDs from archive"""
         try:
-            with ZipFile(self.filepath, mode="r") as archive:
-                if "sample_ids" in archive.namelist():
-                    with archive.open("sample_ids") as obj:
-                        return uncompress(obj.read()).decode().split("\n")
-                else:
-                    print("Warning: 'sample_ids' not found in the archive.")
-                    return []
+            if "sample_ids" in self._archive.namelist():
+                with _stream_reader(self._archive.open("sample_ids")) as obj:
+                    return obj.read().decode().split("\n")
+            else:
+                print("Warning: 'sample_ids' not found in the archive.")
+                return []
         except BadZipFile:
             print("Error: Invalid zip archive format.")
             return []
@@ -270,16 +637,17 @@ class SparseReferencePanel:
     ):
         bp_per_variant = chr_length / num_variants
         bp_per_chunk = bp_per_variant * self.chunk_size
-        current_start = self._determine_start_position(vcf_path)
-        ranges = []
-        while current_start < chr_length:
-            end = min(current_start + bp_per_chunk, chr_length)
-            ranges.append((int(current_start), int(end)))
-            current_start = end + 1
+        starts = np.arange(
+            self._determine_start_position(vcf_path), chr_length, bp_per_chunk + 1
+        )
+        ends = np.minimum(starts + bp_per_chunk, chr_length).astype(np.int64)
+        # derive starts from the previous ends so that ranges never leave gaps
+        starts = starts.astype(np.int64)
+        starts[1:] = ends[:-1] + 1
         # Update the last element to 100Gb in order to ensure that no variants
         # are discarded due to assumptions about chromosome length
-        ranges[-1] = (ranges[-1][0], 100000000000)
-        return ranges
+        ends[-1] = 100000000000
+        return list(zip(starts.tolist(), ends.tolist()))
 
     def _get_vcf_stats(self, vcf_path: Path):
         cmd = ["bcftools", "index", "--stats", vcf_path]
@@ -364,18 +732,20 @@ class SparseReferencePanel:
         ]
         self.variant_dtypes = np.dtype(variant_dtypes)
 
+        # most alleles are repeated many times, so hash each one only once
+        hash_allele = ALLELE_HASHES[ALLELE_HASH]
+        digests = {
+            allele: hash_allele(allele.encode())
+            for allele in {allele for row in variants for allele in row[2:4]}
+        }
         self.variants = np.fromiter(
             [
-                (
-                    row[0],
-                    int(row[1]),
-                    blake2b(row[2].encode(), digest_size=8).hexdigest(),
-                    blake2b(row[3].encode(), digest_size=8).hexdigest(),
-                )
+                (row[0], int(row[1]), digests[row[2]], digests[row[3]])
                 for row in variants
             ],
             dtype=self.variant_dtypes,
         )
+        self._positions = np.ascontiguousarray(self.variants["pos"])
         self.ids = ["-".join([str(col) for col in line]) for line in variants]
 
         self.chunks = np.array(
@@ -390,6 +760,7 @@ class SparseReferencePanel:
             ],
             dtype=int,
         )
+        self._chunk_ids = self._get_chunk_ids()
 
         self.metadata.update(
             {
@@ -400,9 +771,14 @@ class SparseReferencePanel:
                 "n_chunks": self.chunks.shape[0],
                 "n_samples": len(self.sample_ids),
                 "variant_dtypes": variant_dtypes,
+                "allele_hash": ALLELE_HASH,
             }
         )
 
+    def hash_allele(self, allele: str) -> str:
+        """Hash an allele the same way as the variants in the panel"""
+        return ALLELE_HASHES[self.allele_hash](allele.encode())
+
     def _ingest_original_ids(self, vcf_path: Path):
         result = subprocess.run(
             ["bcftools", "query", "-f", "%ID\n", vcf_path],
@@ -423,40 +799,167 @@ class SparseReferencePanel:
             self.metadata["contig_field"] = f"##contig=<ID={chrom}>"
 
     def _load_chunks(self) -> np.ndarray:
-        with ZipFile(self.filepath, mode="r") as archive:
-            with archive.open("chunks") as obj:
-                chunks_ = np.frombuffer(uncompress(obj.read()), dtype=int)
+        with _stream_reader(self._archive.open("chunks")) as obj:
+            chunks_ = np.frombuffer(obj.read(), dtype=int)
         if chunks_.size:
             return np.reshape(chunks_, (self.n_chunks, 3))
         return chunks_
 
-    @cachedmethod(lambda self: self._cache)
+    def _get_chunk_ids(self) -> np.ndarray:
+        """Keep chunk ids contiguous, as they are iterated for every full matrix"""
+        if self.chunks.size:
+            return np.ascontiguousarray(self.chunks[:, 0])
+        return np.array([], dtype=int)
+
+    def _get_cached(
+        self,
+        cache: OrderedDict,
+        chunk: int,
+        load: Callable[[int], sparse.spmatrix],
+        evict: Optional[Callable[[int], None]] = None,
+    ) -> sparse.spmatrix:
+        """Get a chunk from an LRU cache, loading it on a miss"""
+        with self._lock:
+            try:
+                matrix = cache[chunk]
+                cache.move_to_end(chunk)
+                return matrix
+            except KeyError:
+                pass
+        # the lock is not held while loading so that chunks load in parallel
+        matrix = load(chunk)
+        with self._lock:
+            cache[chunk] = matrix
+            cache.move_to_end(chunk)
+            if len(cache) > self._cache_size:
+                evicted, _ = cache.popitem(last=False)
+                if evict is not None:
+                    evict(evicted)
+        return matrix
+
     def _load_haplotypes(self, chunk: int) -> sparse.csc_matrix:
+        """Load a sparse matrix from archived npz, cached"""
+        return self._get_cached(
+            self._cache,
+            chunk,
+            (
+                self._load_shared_haplotypes
+                if self.shared_cache
+                else self._read_haplotypes
+            ),
+            self._unshare_chunk,
+        )
+
+    def _get_shared_key(self) -> str:
+        """Key shared memory blocks of chunks by the file path and version"""
+        stat = os.stat(self.filepath)
+        version = f"{os.path.realpath(self.filepath)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return blake2b(version.encode(), digest_size=8).hexdigest()
+
+    def _load_shared_haplotypes(self, chunk: int) -> sparse.csc_matrix:
+        """
+        Load a sparse matrix from shared memory, adding it if not yet loaded.
+        The mapping is released once no matrix uses it any more.
+        """
+        name = f"srp_{self._shared_key}_{chunk}"
+        block = _attach_shared_memory(name)
+        if block is not None:
+            matrix = _matrix_from_shared_memory(block)
+            if matrix is not None:
+                return matrix
+            # another process is still copying the chunk
+            block.close()
+        matrix = self._read_haplotypes(chunk)
+        block = _share_matrix(name, matrix)
+        if block is None:
+            return matrix
+        # unlinked when the chunk leaves the cache, or at the latest when the panel
+        # is garbage collected or the process exits
+        self._shared_blocks[chunk] = weakref.finalize(self, block.unlink)
+        return _matrix_from_shared_memory(block)
+
+    def _unshare_chunk(self, chunk: int):
+        """Unlink the shared block of a chunk leaving the cache, if created here"""
+        unlink = self._shared_blocks.pop(chunk, None)
+        if unlink is not None:
+            # finalizers run at most once, so this is a no-op after they ran at exit
+            unlink()
+
+    def _read_haplotypes(self, chunk: int) -> sparse.csc_matrix:
         """Load a sparse matrix from archived npz"""
-        with ZipFile(self.filepath, mode="r") as archive:
-            with archive.open(f"haplotypes/{chunk}.npz") as obj:
-                return sparse.load_npz(BytesIO(uncompress(obj.read())))
+        # chunks can be loaded in parallel threads and decompressors
+        # are not thread safe, so each call uses its own
+        decompressor = ZstdDecompressor(dict_data=self._zstd_dict)
+        # npz files are zip archives and need a seekable buffer
+        with _stream_reader(
+            self._archive.open(f"haplotypes/{chunk}.npz"), decompressor
+        ) as obj:
+            return sparse.load_npz(BytesIO(obj.read()))
+
+    def _load_haplotypes_csr(self, chunk: int) -> sparse.csr_matrix:
+        """Load a sparse matrix in csr format for row indexing, cached"""
+        return self._get_cached(
+            self._csr_cache, chunk, lambda chunk: self._load_haplotypes(chunk).tocsr()
+        )
 
     def _load_dosage(self, chunk: int) -> sparse.csc_matrix:
         """Load a sparse matrix dosage from archived npz"""
         loaded_chunk = self._load_haplotypes(chunk)
-        return loaded_chunk[:, ::2] + loaded_chunk[:, 1::2]
+        # sum as integers, boolean addition gives 1 where both haplotypes are alt
+        return loaded_chunk[:, ::2].astype(np.uint8) + loaded_chunk[:, 1::2]
 
     def _calculate_maf(self, chunk: int) -> np.ndarray:
         """Calculate minor allele frequency (maf) for a given chunk."""
         loaded_chunk = self._load_haplotypes(chunk)
-        freqs = (loaded_chunk.sum(axis=1) / self.metadata["n_haps"]).A.squeeze()
-        mask = freqs > 0.5
-        freqs[mask] = 1 - freqs[mask]
-        return freqs
+        alt_counts = np.asarray(loaded_chunk.sum(axis=1, dtype=np.int32)).ravel()
+        n_haps = self.metadata["n_haps"]
+        return np.minimum(alt_counts, n_haps - alt_counts).astype(np.float32) * (
+            1.0 / n_haps
+        )
 
     def _std_out_to_sparse(self, command: str, chunk: int, tmpdir: str) -> tuple:
         """Convert std_out of command to sparse matrix"""
-        result = subprocess.run(command, shell=True, capture_output=True)
-        if result.returncode:
-            raise ValueError(f"Error executing `{command}`: {result.stderr}")
-        if result.stdout == b"":
+        state = np.array([0, 0, -1, 0, 1], dtype=np.int64)
+        capacity = max(2 * len(self.sample_ids), 1024)
+        rows = np.empty(capacity, dtype=np.int32)
+        cols = np.empty(capacity, dtype=np.int32)
+        n_alts = 0
+        last_byte = b""
+        # parse output while the command is running, stderr goes to a file
+        # so that a full stderr pipe cannot block the command
+        with TemporaryFile() as stderr:
+            with subprocess.Popen(
+                command,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                bufsize=STREAM_BLOCK_SIZE,
+            ) as process:
+                while block := process.stdout.read1(STREAM_BLOCK_SIZE):
+                    # every alt allele takes at least "1|", plus one finished
+                    # by the first byte that was started in the previous block
+                    needed = n_alts + len(block) // 2 + 1
+                    if needed > rows.size:
+                        capacity = max(needed, 2 * rows.size)
+                        rows = _grow_array(rows, n_alts, capacity)
+                        cols = _grow_array(cols, n_alts, capacity)
+                    n_alts = parse_gt_stream(
+                        np.frombuffer(block, dtype=np.uint8), state, rows, cols, n_alts
+                    )
+                    last_byte = block[-1:]
+            if process.returncode:
+                stderr.seek(0)
+                raise ValueError(f"Error executing `{command}`: {stderr.read()}")
+        if last_byte == b"":
             raise ValueError(f"No genotypes returned by `{command}`")
+        if last_byte != b"\n":
+            raise ValueError(
+                f"Genotypes returned by `{command}` must end with a newline"
+            )
+        rows = rows[:n_alts]
+        cols = cols[:n_alts]
+        n_rows = int(state[0])
+        n_cols = int(state[2])
 
         # account for when the same position appears in multiple chunks
         offset = 0
@@ -466,21 +969,21 @@ class SparseReferencePanel:
                     offset += 1
                 else:
                     break
+        keep = (rows >= offset) & (rows < offset + self.chunk_size)
         matrix = sparse.csc_matrix(
-            np.loadtxt(BytesIO(result.stdout), delimiter="|", dtype=np.bool_)[
-                offset : offset + self.chunk_size, :
-            ]
+            (
+                np.ones(np.count_nonzero(keep), dtype=np.bool_),
+                (rows[keep] - offset, cols[keep]),
+            ),
+            shape=(max(min(n_rows - offset, self.chunk_size), 0), n_cols),
         )
         # confirm correct number of variants
         assert matrix.shape[0] == self.chunk_size or (
             chunk == self.n_chunks - 1
             and matrix.shape[0] == self.n_variants % self.chunk_size
         )
-        npz_ = BytesIO()
-        sparse.save_npz(npz_, matrix)
-        npz_.seek(0)
-        with open(os.path.join(tmpdir, f"{chunk}.npz"), "wb") as fout:
-            fout.write(compress(npz_.read()))
+        # compressed with zstd when written to the archive
+        sparse.save_npz(os.path.join(tmpdir, f"{chunk}.npz"), matrix, compressed=False)
         return matrix.shape[1]
 
     def _ingest_haplotypes(self, commands: List[str], threads: int = 1):
@@ -514,7 +1017,7 @@ class SparseReferencePanel:
                 f"xsqueezeit -x -f {xsi_path} -p "
                 f'-r "{self.chromosome}:{chunk[1]}-{chunk[2]}" | '
                 f"bcftools query -t {self.chromosome}:{chunk[1]}-{chunk[2]} "
-                "-f '[|%GT]\n' | sed s'/|//'"
+                "-f '[|%GT]\n'"
             )
             for chunk in self.chunks
         ]
@@ -558,7 +1061,7 @@ class SparseReferencePanel:
             (
                 f"bcftools view -r {self.chromosome}:{chunk[1]}-{chunk[2]} "
                 f"{bcf_path} | bcftools query -f '[|%GT]\n' "
-                f"-t {self.chromosome}:{chunk[1]}-{chunk[2]} | sed s'/|//'"
+                f"-t {self.chromosome}:{chunk[1]}-{chunk[2]}"
             )
             for chunk in self.chunks
         ]
@@ -647,6 +1150,21 @@ class SparseReferencePanel:
         """Get contig field"""
         return self.metadata.get("contig_field", "")
 
+    @cached_property
+    def ids(self) -> Sequence[str]:
+        """Get string formatted variant IDs, loaded on first use"""
+        return self._load_ids()
+
+    @cached_property
+    def original_ids(self) -> Sequence[str]:
+        """Get original vcf/bcf variant IDs, loaded on first use"""
+        return self._load_original_ids()
+
+    @property
+    def allele_hash(self) -> str:
+        """Get name of hash function used for alleles"""
+        return self.metadata.get("allele_hash", "blake2b")
+
     @property
     def empty(self) -> bool:
         return self.n_variants == 0 or self.n_haps == 0
@@ -655,7 +1173,7 @@ class SparseReferencePanel:
     def all(self) -> sparse.csc_matrix:
         """Get unsliced sparse matrix of all boolean genotypes"""
         return sparse.vstack(
-            [self._load_haplotypes(chunk) for chunk in self.chunks[:, 0]]
+            self._map_chunks(self._load_haplotypes, self._chunk_ids), format="csc"
         )
 
     def range(
@@ -663,5 +1181,7 @@ class SparseReferencePanel:
     ) -> sparse.csc_matrix:
         """Get sparse matrix of boolean genotypes in position range"""
         max_bp += int(inclusive)
-        positions = np.array([variant[1] for variant in self.variants], dtype=int)
-        return self[positions.searchsorted(min_bp) : positions.searchsorted(max_bp), :]
+        return self[
+            self._positions.searchsorted(min_bp) : self._positions.searchsorted(max_bp),
+            :,
+        ]
@@ -2,7 +2,6 @@ import os
 import shutil
 import sys
 import subprocess
-from hashlib import blake2b
 from pathlib import Path
 import argparse
 import logging
@@ -93,8 +92,8 @@ def selphi(
                 (
                     variant.CHROM,
                     variant.POS,
-                    blake2b(variant.REF.encode(), digest_size=8).hexdigest(),
-                    blake2b(variant.ALT[0].encode(), digest_size=8).hexdigest(),
+                    ref_panel.hash_allele(variant.REF),
+                    ref_panel.hash_allele(variant.ALT[0]),
                 )
                 for variant in vcf_obj
             ],